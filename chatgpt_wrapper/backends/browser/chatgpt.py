@@ -1,13 +1,15 @@
 import os
+import sys
 import asyncio
-import base64
-import json
 import time
 import datetime
 import uuid
-import re
 import shutil
+import functools
+import threading
+import queue
 from typing import Optional
+import orjson
 from playwright.async_api import async_playwright
 from playwright._impl._api_structures import ProxySettings
 
@@ -16,7 +18,180 @@ from chatgpt_wrapper.core.config import Config
 from chatgpt_wrapper.core.logger import Logger
 import chatgpt_wrapper.core.constants as constants
 
+IS_LINUX = sys.platform.startswith('linux')
+
+if IS_LINUX:
+    import fcntl
+
 GEN_TITLE_TIMEOUT = 5000
+BROWSER_POOL_MAX_PAGES = 10
+# ioctl request to clone a file's extents, Linux btrfs/XFS.
+FICLONE = 0x40049409
+STREAM_DONE = object()
+STREAM_INTERRUPT = object()
+
+def clone_file(src, dst):
+    """
+    Copy a file as a copy-on-write clone where the filesystem supports it,
+    otherwise fall back to a regular copy.
+    """
+    if IS_LINUX:
+        try:
+            with open(src, 'rb') as fsrc, open(dst, 'wb') as fdst:
+                fcntl.ioctl(fdst.fileno(), FICLONE, fsrc.fileno())
+            shutil.copystat(src, dst)
+            return dst
+        except OSError:
+            pass
+    return shutil.copy2(src, dst)
+
+class DecodedBody:
+    """
+    Response body for log messages, only decoded if the message is emitted.
+    """
+
+    def __init__(self, body):
+        self.body = body
+
+    def __str__(self):
+        return self.body.decode('utf-8', 'replace')
+
+class BrowserPool:
+    """
+    Shares one persistent browser context between all AsyncChatGPT
+    instances on the same event loop that use the same profile and launch
+    options, handing each of them its own page instead of launching a
+    browser per instance.
+    """
+
+    pools = {}
+
+    @classmethod
+    def get(cls, profile_dir, config, proxy=None, max_pages=BROWSER_POOL_MAX_PAGES, max_concurrent_asks=None):
+        provider = config.get('browser.provider')
+        headless = not config.get('browser.debug')
+        # Playwright objects are bound to the loop that started them, so
+        # pools cannot be shared across loops. Callers asking for different
+        # launch options get a browser of their own.
+        proxy_key = tuple(sorted(proxy.items())) if proxy else None
+        key = (asyncio.get_running_loop(), profile_dir, provider, headless, proxy_key)
+        if key not in cls.pools:
+            cls.pools[key] = cls(key, profile_dir, provider, headless, proxy, max_pages, max_concurrent_asks)
+        return cls.pools[key]
+
+    def __init__(self, key, profile_dir, provider, headless, proxy=None, max_pages=BROWSER_POOL_MAX_PAGES, max_concurrent_asks=None):
+        self.key = key
+        self.profile_dir = profile_dir
+        self.provider = provider
+        self.headless = headless
+        self.proxy = proxy
+        self.user_data_dir = None
+        self.play = None
+        self.browser = None
+        self.pages = 0
+        self.waiters = 0
+        self.lock = asyncio.Lock()
+        self.page_semaphore = asyncio.Semaphore(max_pages)
+        # Asks on different pages can run in parallel, up to this limit, but
+        # a single page can only run one at a time.
+        self.max_concurrent_asks = max_concurrent_asks or max_pages
+        self.ask_semaphore = asyncio.Semaphore(self.max_concurrent_asks)
+        self.page_locks = {}
+
+    async def _launch(self, log):
+        self.play = await async_playwright().start()
+        try:
+            self.browser = await self._launch_browser(log)
+        except Exception:
+            await self.play.stop()
+            self.play = None
+            if self.user_data_dir:
+                shutil.rmtree(self.user_data_dir, ignore_errors=True)
+                self.user_data_dir = None
+            raise
+
+    async def _launch_browser(self, log):
+        try:
+            playbrowser = getattr(self.play, self.provider)
+        except Exception:
+            print(f"Browser {self.provider} is invalid, falling back on firefox")
+            playbrowser = self.play.firefox
+        try:
+            return await playbrowser.launch_persistent_context(
+                user_data_dir=self.profile_dir,
+                headless=self.headless,
+                proxy=self.proxy,
+            )
+        except Exception:
+            self.user_data_dir = f"{self.profile_dir}-{str(uuid.uuid4())}"
+            message = f"Unable to launch browser from primary profile, trying alternate profile {self.user_data_dir}"
+            print(message)
+            log.warning(message)
+            # Profiles can be large, copy in a thread to keep the loop free.
+            copy = functools.partial(shutil.copytree, self.profile_dir, self.user_data_dir, copy_function=clone_file, ignore=shutil.ignore_patterns("lock"))
+            await asyncio.get_running_loop().run_in_executor(None, copy)
+            return await playbrowser.launch_persistent_context(
+                user_data_dir=self.user_data_dir,
+                headless=self.headless,
+                proxy=self.proxy,
+            )
+
+    async def acquire(self, log):
+        """
+        Get a page of the shared browser, launching it on first use.
+
+        Waits if the maximum number of pages are already handed out.
+        """
+        # Counted before the first await, so a pool found by get() can't be
+        # dropped from the registry while its caller waits here.
+        self.waiters += 1
+        try:
+            await self.page_semaphore.acquire()
+            try:
+                async with self.lock:
+                    if self.browser is None:
+                        await self._launch(log)
+                    # The browser opens with a blank page, hand that out first.
+                    if self.pages == 0 and len(self.browser.pages) > 0:
+                        page = self.browser.pages[0]
+                    else:
+                        page = await self.browser.new_page()
+                    self.pages += 1
+                    self.page_locks[page] = asyncio.Lock()
+            except Exception:
+                self.page_semaphore.release()
+                raise
+        finally:
+            self.waiters -= 1
+        return page
+
+    async def release(self, page):
+        """
+        Give back a page, shutting the browser down once none are left.
+        """
+        async with self.lock:
+            self.pages -= 1
+            self.page_locks.pop(page, None)
+            if self.pages > 0:
+                await page.close()
+            else:
+                await self._close()
+        self.page_semaphore.release()
+
+    async def _close(self):
+        # With callers still waiting in acquire() the pool stays registered,
+        # and the next of them launches a fresh browser.
+        if not self.waiters:
+            self.pools.pop(self.key, None)
+        await self.browser.close()
+        # remove the user data dir in case this is a second instance
+        if self.user_data_dir:
+            shutil.rmtree(self.user_data_dir)
+        await self.play.stop()
+        self.browser = None
+        self.play = None
+        self.user_data_dir = None
+
 
 class AsyncChatGPT(Backend):
     """
@@ -25,58 +200,98 @@ class AsyncChatGPT(Backend):
     order to provide an open API to ChatGPT.
     """
 
-    stream_div_id = "chatgpt-wrapper-conversation-stream-data"
-    eof_div_id = "chatgpt-wrapper-conversation-stream-data-eof"
-    interrupt_div_id = "chatgpt-wrapper-conversation-stream-data-interrupt"
     session_div_id = "chatgpt-wrapper-session-data"
+    interrupt_stream_js = "window.cwInterrupt && window.cwInterrupt()"
+    stream_request_js = """
+        const xhr = new XMLHttpRequest();
+        xhr.open('POST', 'https://chat.openai.com/backend-api/conversation');
+        xhr.setRequestHeader('Accept', 'text/event-stream');
+        xhr.setRequestHeader('Content-Type', 'application/json');
+        xhr.setRequestHeader('Authorization', 'Bearer {BEARER_TOKEN}');
+        xhr.responseType = 'stream';
+        // tags every event, so ones from an earlier request can be told apart.
+        const streamId = {STREAM_ID};
+        const interrupt = function() {{
+          console.warn('Interrupting stream');
+          xhr.abort();
+        }};
+        window.cwInterrupt = interrupt;
+        var seenBytes = 0;
+        var seenLength = 0;
+        xhr.onreadystatechange = function() {{
+          if(xhr.readyState == 3 || xhr.readyState == 4) {{
+            // only look at complete events received since the last call.
+            const responseText = xhr.responseText;
+            const end = responseText.lastIndexOf("\\n\\n");
+            if(end >= seenBytes) {{
+              const newEvents = responseText.substring(seenBytes, end).split(/\\n\\n/);
+              seenBytes = end + 2;
+              // every event carries the full message so far, so only the
+              // newest one is needed, and only its new text is sent back.
+              for(let i = newEvents.length - 1; i >= 0; i--) {{
+                if(!newEvents[i].startsWith("data: {{")) {{
+                  continue;
+                }}
+                var event;
+                try {{
+                  event = JSON.parse(newEvents[i].substring(6));
+                }} catch (err) {{
+                  console.log(err);
+                  continue;
+                }}
+                if(typeof event.message === 'undefined' || event.message === null) {{
+                  continue;
+                }}
+                try {{
+                  const message = event.message.content.parts.join("\\n");
+                  window.cwPush(streamId, message.substring(seenLength), event.message.id, event.conversation_id);
+                  seenLength = message.length;
+                }} catch (err) {{
+                  console.log(err);
+                  window.cwPush(streamId, null);
+                }}
+                break;
+              }}
+            }}
+          }}
+          if(xhr.readyState == 4) {{
+            if(window.cwInterrupt === interrupt) {{
+              delete window.cwInterrupt;
+            }}
+            window.cwDone(streamId);
+          }}
+        }};
+        xhr.send({REQUEST_JSON});
+        """
 
     def __init__(self, config=None):
         super().__init__(config)
+        self.pool = None
         self.play = None
-        self.user_data_dir = None
         self.page = None
         self.browser = None
         self.session = None
+        self._base_headers = {}
+        self._stream_loop = None
+        self._stream_queue = None
+        self._stream_id = None
         self.new_conversation()
 
     def get_primary_profile_directory(self):
         primary_profile = os.path.join(self.config.data_profile_dir, "playwright")
         return primary_profile
 
-    async def create(self, timeout=60, proxy: Optional[ProxySettings] = None):
+    async def create(self, timeout=60, proxy: Optional[ProxySettings] = None, max_concurrent_asks=None):
         primary_profile = self.get_primary_profile_directory()
         self.streaming = False
-        self.lock = asyncio.Lock()
-        self.play = await async_playwright().start()
-        browser = self.config.get('browser.provider')
-        headless = not self.config.get('browser.debug')
-        try:
-            playbrowser = getattr(self.play, browser)
-        except Exception:
-            print(f"Browser {browser} is invalid, falling back on firefox")
-            playbrowser = self.play.firefox
-        try:
-            self.browser = await playbrowser.launch_persistent_context(
-                user_data_dir=primary_profile,
-                headless=headless,
-                proxy=proxy,
-            )
-        except Exception:
-            self.user_data_dir = f"{primary_profile}-{str(uuid.uuid4())}"
-            message = f"Unable to launch browser from primary profile, trying alternate profile {self.user_data_dir}"
-            print(message)
-            self.log.warning(message)
-            shutil.copytree(primary_profile, self.user_data_dir, ignore=shutil.ignore_patterns("lock"))
-            self.browser = await playbrowser.launch_persistent_context(
-                user_data_dir=self.user_data_dir,
-                headless=headless,
-                proxy=proxy,
-            )
-
-        if len(self.browser.pages) > 0:
-            self.page = self.browser.pages[0]
-        else:
-            self.page = await self.browser.new_page()
+        self.pool = BrowserPool.get(primary_profile, self.config, proxy, max_concurrent_asks=max_concurrent_asks)
+        # The limit is set by whichever instance created the pool.
+        if max_concurrent_asks is not None and max_concurrent_asks != self.pool.max_concurrent_asks:
+            self.log.warning(f"Ignoring max_concurrent_asks={max_concurrent_asks}, the shared browser already uses {self.pool.max_concurrent_asks}")
+        self.page = await self.pool.acquire(self.log)
+        self.play = self.pool.play
+        self.browser = self.pool.browser
+        await self._expose_stream_bindings()
         await self._start_browser()
         self.timeout = timeout
         self.log.info("ChatGPT initialized")
@@ -93,6 +308,32 @@ class AsyncChatGPT(Backend):
         loop = asyncio.get_event_loop()
         loop.run_until_complete(asyncio.gather(self.cleanup()))
 
+    async def _expose_stream_bindings(self):
+        # The injected stream request pushes events back through these
+        # bindings, so ask_stream() never has to poll the DOM.
+        await asyncio.gather(
+            self.page.expose_binding("cwPush", self._on_stream_push),
+            self.page.expose_binding("cwDone", self._on_stream_done),
+        )
+
+    def _on_stream_push(self, _source, stream_id, chunk, message_id=None, conversation_id=None):
+        # Drop anything still arriving from an earlier request.
+        if self._stream_queue is not None and stream_id == self._stream_id:
+            self._stream_queue.put_nowait((chunk, message_id, conversation_id))
+
+    def _on_stream_done(self, _source, stream_id):
+        if self._stream_queue is not None and stream_id == self._stream_id:
+            self._stream_queue.put_nowait(STREAM_DONE)
+
+    def terminate_stream(self, _signal, _frame):
+        super().terminate_stream(_signal, _frame)
+        # Wake up ask_stream() so it sees the interrupt right away, this may be
+        # called from a signal handler or another thread.
+        stream_loop = self._stream_loop
+        stream_queue = self._stream_queue
+        if stream_loop is not None and stream_queue is not None and not stream_loop.is_closed():
+            stream_loop.call_soon_threadsafe(stream_queue.put_nowait, STREAM_INTERRUPT)
+
     async def _start_browser(self):
         await self.page.goto("https://chat.openai.com/")
 
@@ -103,11 +344,8 @@ class AsyncChatGPT(Backend):
 
     async def cleanup(self):
         self.log.info("Cleaning up")
-        await self.browser.close()
-        # remove the user data dir in case this is a second instance
-        if self.user_data_dir:
-            shutil.rmtree(self.user_data_dir)
-        await self.play.stop()
+        await self.pool.release(self.page)
+        self.page = None
 
     def get_backend_name(self):
         return "chatgpt-browser"
@@ -150,46 +388,43 @@ class AsyncChatGPT(Backend):
 
             The following code tries to extract the json part from the page, by simply finding the first `{` and the last `}`.
             """
-            found_json = re.search('{.*}', contents)
-            if found_json is None:
-                raise json.JSONDecodeError("Cannot find JSON in /api/auth/session 's response", contents, 0)
-            contents = contents[found_json.start():found_json.end()]
+            start = contents.find('{')
+            end = contents.rfind('}')
+            if start < 0 or end < start:
+                raise orjson.JSONDecodeError("Cannot find JSON in /api/auth/session 's response", contents, 0)
+            contents = contents[start:end + 1]
             self.log.debug("Refreshing session received: %s", contents)
-            self.session = json.loads(contents)
+            self.session = orjson.loads(contents)
+            if "accessToken" in self.session:
+                self._base_headers = {
+                    "Authorization": f"Bearer {self.session['accessToken']}",
+                }
+            else:
+                self._base_headers = {}
             self.log.info("Succeessfully refreshed session. ")
-        except json.JSONDecodeError:
+        except orjson.JSONDecodeError:
             self.log.error("Failed to decode session key. Maybe Access denied? ")
 
         # Now the browser should be at /api/auth/session
         # Go back to the chat page.
         await self._start_browser()
 
-    async def _cleanup_divs(self):
-        await self.page.evaluate(f"document.getElementById('{self.stream_div_id}').remove()")
-        code = (
-            """
-            const eof_div = document.getElementById('EOF_DIV_ID');
-            if(typeof eof_div !== 'undefined' && eof_div !== null) {
-              eof_div.remove();
-            }
-            """
-        ).replace("EOF_DIV_ID", self.eof_div_id)
-        await self.page.evaluate(code)
-
     def _api_request_build_headers(self, custom_headers={}):
-        headers = {
-            "Authorization": f"Bearer {self.session['accessToken']}",
-        }
-        headers.update(custom_headers)
-        return headers
+        # The base headers only change when the session is refreshed, so
+        # they are built there and shared by every request that needs nothing extra.
+        if custom_headers:
+            return {**self._base_headers, **custom_headers}
+        return self._base_headers
 
     async def _process_api_response(self, url, response, method="GET"):
-        self.log.debug(f"{method} {url} response, OK: {response.ok}, TEXT: {await response.text()}")
+        # Fetch the body once, both the debug log and the decoding use it.
+        body = await response.body()
+        self.log.debug("%s %s response, OK: %s, TEXT: %s", method, url, response.ok, DecodedBody(body))
         json = None
         if response.ok:
             try:
-                json = await response.json()
-            except json.JSONDecodeError:
+                json = orjson.loads(body)
+            except orjson.JSONDecodeError:
                 pass
         if not response.ok or not json:
             self.log.debug(f"{response.status} {response.status_text} {response.headers}")
@@ -252,27 +487,36 @@ class AsyncChatGPT(Backend):
             self.log.warning("Failed to auto-generate title for new conversation")
 
     def conversation_data_to_messages(self, conversation_data):
-        mapping_dict = conversation_data['mapping'].values()
         messages = []
-        parent_nodes = [item for item in mapping_dict if 'parent' not in item]
-        mapping_dict = [item for item in mapping_dict if 'parent' in item]
+        parent_nodes = []
+        # Index each node by its parent, keeping the first child found, so
+        # the thread can be walked without rescanning the whole mapping.
+        children_by_parent = {}
+        for item in conversation_data['mapping'].values():
+            if 'parent' in item:
+                children_by_parent.setdefault(item['parent'], item)
+            else:
+                parent_nodes.append(item)
         if len(parent_nodes) == 1 and 'children' in parent_nodes[0]:
             parent_id = parent_nodes[0]['children'][0]
         else:
             parent_id = None
-        while True:
-            current_item = next((item for item in mapping_dict if item['parent'] == parent_id), None)
-            if current_item is None:
-                return messages
+        fromtimestamp = datetime.datetime.fromtimestamp
+        current_item = children_by_parent.get(parent_id)
+        while current_item is not None:
             message = current_item['message']
-            if message is not None and 'content' in message and 'author' in message and message['author']['role'] != 'system':
-                messages.append({
-                    'id': message['id'],
-                    'role': message['author']['role'],
-                    'message': "".join(message['content']['parts']),
-                    'created_time': datetime.datetime.fromtimestamp(int(message['create_time'])),
-                })
-            parent_id = current_item['id']
+            if message is not None:
+                author = message.get('author')
+                content = message.get('content')
+                if author is not None and content is not None and author['role'] != 'system':
+                    messages.append({
+                        'id': message['id'],
+                        'role': author['role'],
+                        'message': "".join(content['parts']),
+                        'created_time': fromtimestamp(message['create_time']),
+                    })
+            current_item = children_by_parent.get(current_item['id'])
+        return messages
 
     async def delete_conversation(self, uuid=None):
         if self.session is None:
@@ -316,8 +560,12 @@ class AsyncChatGPT(Backend):
         if ok:
             history = {}
             for item in json["items"]:
-                item['created_time'] = datetime.datetime.strptime(item['create_time'], "%Y-%m-%dT%H:%M:%S.%f")
-                del item['create_time']
+                create_time = item.pop('create_time')
+                try:
+                    item['created_time'] = datetime.datetime.fromisoformat(create_time)
+                except ValueError:
+                    # Before Python 3.11 fromisoformat() only takes 3 or 6 digit fractions.
+                    item['created_time'] = datetime.datetime.strptime(create_time, "%Y-%m-%dT%H:%M:%S.%f")
                 history[item["id"]] = item
             return ok, history, "Retrieved history"
         else:
@@ -337,6 +585,19 @@ class AsyncChatGPT(Backend):
                 return self._handle_error(json, response, f"Failed to get conversation {uuid}")
 
     async def ask_stream(self, prompt, title=None, model_customizations={}):
+        # A page can only run one stream at a time, wait for this page first
+        # so streams queued on it don't hold slots other pages could use.
+        async with self.pool.page_locks[self.page], self.pool.ask_semaphore:
+            stream = self._ask_stream(prompt, title=title)
+            try:
+                async for chunk in stream:
+                    yield chunk
+            finally:
+                # Close it here, while the page is still held, rather than
+                # leaving it for the garbage collector.
+                await stream.aclose()
+
+    async def _ask_stream(self, prompt, title=None):
         if self.session is None:
             await self.refresh_session()
 
@@ -364,123 +625,79 @@ class AsyncChatGPT(Backend):
             "action": "next",
         }
 
-        code = (
-            """
-            const stream_div = document.createElement('DIV');
-            stream_div.id = "STREAM_DIV_ID";
-            document.body.appendChild(stream_div);
-            const xhr = new XMLHttpRequest();
-            xhr.open('POST', 'https://chat.openai.com/backend-api/conversation');
-            xhr.setRequestHeader('Accept', 'text/event-stream');
-            xhr.setRequestHeader('Content-Type', 'application/json');
-            xhr.setRequestHeader('Authorization', 'Bearer BEARER_TOKEN');
-            xhr.responseType = 'stream';
-            xhr.onreadystatechange = function() {
-              var newEvent;
-              const interrupt_div = document.getElementById('INTERRUPT_DIV_ID');
-              if(xhr.readyState == 3 || xhr.readyState == 4) {
-                const newData = xhr.response.substr(xhr.seenBytes);
-                try {
-                  const newEvents = newData.split(/\\n\\n/).reverse();
-                  newEvents.shift();
-                  if(newEvents[0] == "data: [DONE]") {
-                    newEvents.shift();
-                  }
-                  if(newEvents.length > 0) {
-                    newEvent = newEvents[0].substring(6);
-                    // using XHR for eventstream sucks and occasionally ive seen incomplete
-                    // json objects come through  JSON.parse will throw if that happens, and
-                    // that should just skip until we get a full response.
-                    JSON.parse(newEvent);
-                  }
-                } catch (err) {
-                  console.log(err);
-                  newEvent = undefined;
-                }
-                if(newEvent !== undefined) {
-                  stream_div.innerHTML = btoa(newEvent);
-                  xhr.seenBytes = xhr.responseText.length;
-                }
-              }
-              if(xhr.readyState == 4 && (typeof interrupt_div === 'undefined' || interrupt_div === null)) {
-                const eof_div = document.createElement('DIV');
-                eof_div.id = "EOF_DIV_ID";
-                document.body.appendChild(eof_div);
-              }
-              if(typeof interrupt_div !== 'undefined' && interrupt_div !== null) {
-                console.warn('Interrupting stream');
-                xhr.abort();
-                interrupt_div.remove();
-              }
-            };
-            xhr.send(JSON.stringify(REQUEST_JSON));
-            """.replace(
-                "BEARER_TOKEN", self.session["accessToken"]
-            )
-            .replace("REQUEST_JSON", json.dumps(request))
-            .replace("STREAM_DIV_ID", self.stream_div_id)
-            .replace("EOF_DIV_ID", self.eof_div_id)
-            .replace("INTERRUPT_DIV_ID", self.interrupt_div_id)
-        )
+        code = self.stream_request_js.format_map({
+            "STREAM_ID": orjson.dumps(new_message_id).decode(),
+            "BEARER_TOKEN": self.session["accessToken"],
+            # A JS string literal holding the JSON text, sent to the server as-is.
+            "REQUEST_JSON": orjson.dumps(orjson.dumps(request).decode()).decode(),
+        })
 
         self.log.debug(f"Sending stream request -- model: {self.model}, conversation_id: {self.conversation_id}, parent_message_id: {self.parent_message_id}")
+        stream_queue = asyncio.Queue()
         self.streaming = True
-        await self.page.evaluate(code)
+        self._stream_loop = asyncio.get_running_loop()
+        self._stream_queue = stream_queue
+        self._stream_id = new_message_id
 
-        last_event_msg = ""
+        message_parts = []
         start_time = time.time()
-        while True:
-            if not self.streaming:
-                self.log.info("Request to interrupt streaming")
-                await self.interrupt_stream()
-                break
-            eof_datas = await self.page.query_selector_all(f"div#{self.eof_div_id}")
-
-            conversation_datas = await self.page.query_selector_all(
-                f"div#{self.stream_div_id}"
-            )
-            if len(conversation_datas) == 0:
-                continue
-
-            full_event_message = None
-
-            try:
-                event_raw = base64.b64decode(await conversation_datas[0].inner_html())
-                if len(event_raw) > 0:
-                    event = json.loads(event_raw)
-                    if event is not None:
-                        self.parent_message_id = event["message"]["id"]
-                        self.conversation_id = event["conversation_id"]
-                        full_event_message = "\n".join(
-                            event["message"]["content"]["parts"]
-                        )
-            except Exception:
-                yield (
-                    "Failed to read response from ChatGPT.  Tips:\n"
-                    " * Try again.  ChatGPT can be flaky.\n"
-                    " * Use the `session` command to refresh your session, and then try again.\n"
-                    " * Restart the program in the `install` mode and make sure you are logged in."
-                )
-                break
-
-            if full_event_message is not None:
-                chunk = full_event_message[len(last_event_msg):]
-                self.message_clipboard = last_event_msg = full_event_message
+        sent = False
+        done = False
+        interrupted = False
+        try:
+            await self.page.evaluate(code)
+            sent = True
+            while True:
+                if not self.streaming:
+                    self.log.info("Request to interrupt streaming")
+                    interrupted = True
+                    break
+                # Give up if nothing at all has arrived within the timeout, once
+                # the response has started wait for as long as it keeps going.
+                wait = None if message_parts else max(start_time + self.timeout - time.time(), 0)
+                try:
+                    event = await asyncio.wait_for(stream_queue.get(), wait)
+                except asyncio.TimeoutError:
+                    break
+                # The request completed, everything has been received.
+                if event is STREAM_DONE:
+                    done = True
+                    break
+                if event is STREAM_INTERRUPT:
+                    continue
+
+                chunk, message_id, conversation_id = event
+                if chunk is None:
+                    yield (
+                        "Failed to read response from ChatGPT.  Tips:\n"
+                        " * Try again.  ChatGPT can be flaky.\n"
+                        " * Use the `session` command to refresh your session, and then try again.\n"
+                        " * Restart the program in the `install` mode and make sure you are logged in."
+                    )
+                    break
+                self.parent_message_id = message_id
+                self.conversation_id = conversation_id
+                message_parts.append(chunk)
                 yield chunk
-
-            # if we saw the eof signal, this was the last event we
-            # should process and we are done
-            if len(eof_datas) > 0 or (((time.time() - start_time) > self.timeout) and full_event_message is None):
-                break
-
-            await asyncio.sleep(0.2)
-
-        if not self.streaming:
+        finally:
+            # Anything but a completed request leaves the XHR running in the
+            # page, stop it so it can't feed into a later request.
+            if sent and not done:
+                await self.interrupt_stream()
+            # Also runs when the caller closes or cancels the stream part
+            # way through, so the backend is left ready for the next one.
+            if self._stream_id == new_message_id:
+                self.streaming = False
+                self._stream_loop = None
+                self._stream_queue = None
+                self._stream_id = None
+
+        if message_parts:
+            self.message_clipboard = "".join(message_parts)
+        if interrupted:
             yield (
                 "\nGeneration stopped\n"
             )
-        self.streaming = False
-        await self._cleanup_divs()
         if title:
             await self.set_title(title)
         else:
@@ -488,14 +705,7 @@ class AsyncChatGPT(Backend):
 
     async def interrupt_stream(self):
         self.log.info("Interrupting stream")
-        code = (
-            """
-            const interrupt_div = document.createElement('DIV');
-            interrupt_div.id = "INTERRUPT_DIV_ID";
-            document.body.appendChild(interrupt_div);
-            """
-        ).replace("INTERRUPT_DIV_ID", self.interrupt_div_id)
-        await self.page.evaluate(code)
+        await self.page.evaluate(self.interrupt_stream_js)
 
     async def ask(self, message, title=None, model_customizations={}):
         """
@@ -507,12 +717,11 @@ class AsyncChatGPT(Backend):
         Returns:
             str: The response received from OpenAI.
         """
-        async with self.lock:
-            response = list([i async for i in self.ask_stream(message, title=title)])
-            if len(response) == 0:
-                return False, response, "Unusable response produced, maybe login session expired. Try 'pkill firefox' and 'chatgpt install'"
-            else:
-                return True, ''.join(response), "Response received"
+        response = [i async for i in self.ask_stream(message, title=title)]
+        if len(response) == 0:
+            return False, response, "Unusable response produced, maybe login session expired. Try 'pkill firefox' and 'chatgpt install'"
+        else:
+            return True, ''.join(response), "Response received"
 
     def new_conversation(self):
         super().new_conversation()
@@ -521,11 +730,34 @@ class AsyncChatGPT(Backend):
 
 class ChatGPT:
 
+    # All instances run their async calls on one shared event loop, in its
+    # own thread, so they can share browsers through BrowserPool. It's
+    # started by the first instance and stopped when the last one closes.
+    loop = None
+    loop_thread = None
+    loop_users = 0
+    loop_lock = threading.Lock()
+
     def __init__(self, config=None, timeout=60, proxy: Optional[ProxySettings] = None):
         self.config = config or Config()
         self.log = Logger(self.__class__.__name__, self.config)
+        self._loop = self._open_loop()
         self.agpt = AsyncChatGPT(config)
-        self.async_run(self.agpt.create(timeout, proxy))
+        try:
+            self.async_run(self.agpt.create(timeout, proxy))
+        except Exception:
+            self.close()
+            raise
+
+    @classmethod
+    def _open_loop(cls):
+        with cls.loop_lock:
+            if cls.loop is None:
+                cls.loop = asyncio.new_event_loop()
+                cls.loop_thread = threading.Thread(target=cls.loop.run_forever, daemon=True)
+                cls.loop_thread.start()
+            cls.loop_users += 1
+            return cls.loop
 
     def __getattr__(self, __name: str):
         if hasattr(self.agpt, __name):
@@ -534,33 +766,36 @@ class ChatGPT:
             raise AttributeError(f"'{self.__class__.__name__}' object has no attribute '{__name}'")
 
     def async_run(self, awaitable):
-        loop = asyncio.get_event_loop()
-        if loop.is_running():
-            future = asyncio.run_coroutine_threadsafe(awaitable, loop)
-            return future.result()
-        else:
-            return loop.run_until_complete(awaitable)
+        return asyncio.run_coroutine_threadsafe(awaitable, self._loop).result()
 
     def refresh_session(self):
         return self.async_run(self.agpt.refresh_session())
 
     def ask_stream(self, prompt, title=None, model_customizations={}):
-        def iter_over_async(ait):
-            loop = asyncio.get_event_loop()
-            ait = ait.__aiter__()
+        # The stream is drained on the loop thread in a single task, and
+        # handed over to this generator through a thread-safe queue.
+        chunks = queue.Queue()
 
-            async def get_next():
-                try:
-                    obj = await ait.__anext__()
-                    return False, obj
-                except StopAsyncIteration:
-                    return True, None
+        async def drain():
+            try:
+                async for chunk in self.agpt.ask_stream(prompt, title=title):
+                    chunks.put((False, chunk))
+            except Exception as e:
+                chunks.put((True, e))
+            else:
+                chunks.put((True, None))
+
+        future = asyncio.run_coroutine_threadsafe(drain(), self._loop)
+        try:
             while True:
-                done, obj = loop.run_until_complete(get_next())
+                done, obj = chunks.get()
                 if done:
+                    if obj is not None:
+                        raise obj
                     break
                 yield obj
-        yield from iter_over_async(self.agpt.ask_stream(prompt, title=title))
+        finally:
+            future.cancel()
 
     def ask(self, message, title=None, model_customizations={}):
         return self.async_run(self.agpt.ask(message, title=title))
@@ -579,3 +814,20 @@ class ChatGPT:
 
     def cleanup(self):
         self.async_run(self.agpt.cleanup())
+        self.close()
+
+    def close(self):
+        cls = self.__class__
+        with cls.loop_lock:
+            if self._loop is None:
+                return
+            self._loop = None
+            cls.loop_users -= 1
+            if cls.loop_users > 0:
+                return
+            loop, loop_thread = cls.loop, cls.loop_thread
+            cls.loop = None
+            cls.loop_thread = None
+            loop.call_soon_threadsafe(loop.stop)
+            loop_thread.join()
+            loop.close()
@@ -0,0 +1,208 @@
+import os
+import filecmp
+import tempfile
+import datetime
+import pytest
+
+from chatgpt_wrapper.core.config import Config
+import chatgpt_wrapper.backends.browser.chatgpt as chatgpt
+from chatgpt_wrapper.backends.browser.chatgpt import AsyncChatGPT, BrowserPool, clone_file
+import chatgpt_wrapper.core.util as util
+
+TEST_DIR = os.path.join(tempfile.gettempdir(), 'chatgpt_wrapper_test')
+TEST_CONFIG_DIR = os.path.join(TEST_DIR, 'config')
+TEST_DATA_DIR = os.path.join(TEST_DIR, 'data')
+TEST_PROFILE = 'test'
+NO_PARENT = object()
+
+
+@pytest.fixture
+def test_config():
+    util.remove_and_create_dir(TEST_CONFIG_DIR)
+    util.remove_and_create_dir(TEST_DATA_DIR)
+    config = Config(TEST_CONFIG_DIR, TEST_DATA_DIR, profile=TEST_PROFILE)
+    return config
+
+
+@pytest.fixture
+def backend(test_config):
+    return AsyncChatGPT(test_config)
+
+
+@pytest.fixture
+def browser_pools():
+    yield BrowserPool.pools
+    BrowserPool.pools.clear()
+
+
+def make_node(id, role=None, text='', parent=NO_PARENT, children=None, create_time=1680000000.5):
+    node = {
+        'id': id,
+        'message': None,
+    }
+    if children is not None:
+        node['children'] = children
+    if parent is not NO_PARENT:
+        node['parent'] = parent
+    if role is not None:
+        node['message'] = {
+            'id': id,
+            'author': {'role': role},
+            'content': {'content_type': 'text', 'parts': [text]},
+            'create_time': create_time,
+        }
+    return node
+
+
+def make_conversation(*nodes):
+    return {'mapping': {node['id']: node for node in nodes}}
+
+
+class StubPage:
+
+    def __init__(self, content):
+        self._content = content
+
+    async def goto(self, url):
+        pass
+
+    async def wait_for_url(self, url, timeout=None):
+        pass
+
+    async def content(self):
+        return self._content
+
+
+def session_page(session):
+    return f'<html><body><pre>{session}</pre></body></html>'
+
+
+def test_conversation_data_to_messages_walks_thread(backend):
+    conversation_data = make_conversation(
+        make_node('root', children=['system']),
+        make_node('system', role='system', parent='root', children=['user1']),
+        make_node('user1', role='user', text='Hello', parent='system', children=['assistant1']),
+        make_node('assistant1', role='assistant', text='Hi there', parent='user1', create_time=1680000001),
+    )
+    messages = backend.conversation_data_to_messages(conversation_data)
+    assert messages == [
+        {
+            'id': 'user1',
+            'role': 'user',
+            'message': 'Hello',
+            'created_time': datetime.datetime.fromtimestamp(1680000000.5),
+        },
+        {
+            'id': 'assistant1',
+            'role': 'assistant',
+            'message': 'Hi there',
+            'created_time': datetime.datetime.fromtimestamp(1680000001),
+        },
+    ]
+
+
+def test_conversation_data_to_messages_first_child_wins(backend):
+    conversation_data = make_conversation(
+        make_node('root', children=['system']),
+        make_node('system', role='system', parent='root', children=['user1']),
+        make_node('user1', role='user', text='Hello', parent='system', children=['assistant1', 'assistant2']),
+        make_node('assistant1', role='assistant', text='First', parent='user1', children=['user2']),
+        make_node('assistant2', role='assistant', text='Second', parent='user1', children=['user3']),
+        make_node('user2', role='user', text='After first', parent='assistant1'),
+        make_node('user3', role='user', text='After second', parent='assistant2'),
+    )
+    messages = backend.conversation_data_to_messages(conversation_data)
+    assert [m['id'] for m in messages] == ['user1', 'assistant1', 'user2']
+
+
+def test_conversation_data_to_messages_skips_empty_and_system_messages(backend):
+    conversation_data = make_conversation(
+        make_node('root', children=['system']),
+        make_node('system', role='system', parent='root', children=['empty']),
+        make_node('empty', parent='system', children=['system2']),
+        make_node('system2', role='system', text='Be helpful', parent='empty', children=['user1']),
+        make_node('user1', role='user', text='Hello', parent='system2'),
+    )
+    messages = backend.conversation_data_to_messages(conversation_data)
+    assert [m['id'] for m in messages] == ['user1']
+
+
+def test_conversation_data_to_messages_root_without_children(backend):
+    conversation_data = make_conversation(
+        make_node('root'),
+        make_node('user1', role='user', text='Hello', parent=None, children=['assistant1']),
+        make_node('assistant1', role='assistant', text='Hi there', parent='user1'),
+    )
+    messages = backend.conversation_data_to_messages(conversation_data)
+    assert [m['id'] for m in messages] == ['user1', 'assistant1']
+
+
+def test_api_request_build_headers_without_custom_headers(backend):
+    backend._base_headers = {'Authorization': 'Bearer token'}
+    assert backend._api_request_build_headers() == {'Authorization': 'Bearer token'}
+
+
+def test_api_request_build_headers_with_custom_headers(backend):
+    backend._base_headers = {'Authorization': 'Bearer token'}
+    headers = backend._api_request_build_headers({'Content-Type': 'application/json'})
+    assert headers == {'Authorization': 'Bearer token', 'Content-Type': 'application/json'}
+    assert backend._base_headers == {'Authorization': 'Bearer token'}
+
+
+@pytest.mark.asyncio
+async def test_refresh_session_sets_base_headers(backend):
+    backend.page = StubPage(session_page('{"accessToken": "token"}'))
+    await backend.refresh_session()
+    assert backend._base_headers == {'Authorization': 'Bearer token'}
+
+
+@pytest.mark.asyncio
+async def test_refresh_session_without_token_clears_base_headers(backend):
+    backend._base_headers = {'Authorization': 'Bearer stale'}
+    backend.page = StubPage(session_page('{}'))
+    await backend.refresh_session()
+    assert backend.session == {}
+    assert backend._api_request_build_headers() == {}
+
+
+@pytest.mark.asyncio
+async def test_browser_pool_shared_for_same_launch_options(test_config, browser_pools):
+    pool = BrowserPool.get(TEST_DATA_DIR, test_config)
+    assert BrowserPool.get(TEST_DATA_DIR, test_config) is pool
+    assert pool.browser is None
+
+
+@pytest.mark.asyncio
+async def test_browser_pool_separate_per_launch_options(test_config, browser_pools):
+    test_config.set('browser.provider', 'firefox')
+    test_config.set('browser.debug', False)
+    pool = BrowserPool.get(TEST_DATA_DIR, test_config)
+    test_config.set('browser.provider', 'chromium')
+    provider_pool = BrowserPool.get(TEST_DATA_DIR, test_config)
+    test_config.set('browser.provider', 'firefox')
+    test_config.set('browser.debug', True)
+    headless_pool = BrowserPool.get(TEST_DATA_DIR, test_config)
+    test_config.set('browser.debug', False)
+    proxy_pool = BrowserPool.get(TEST_DATA_DIR, test_config, proxy={'server': 'http://localhost:8080'})
+    pools = [pool, provider_pool, headless_pool, proxy_pool]
+    assert len(set(map(id, pools))) == 4
+    assert provider_pool.provider == 'chromium'
+    assert not headless_pool.headless
+    assert proxy_pool.proxy == {'server': 'http://localhost:8080'}
+    assert all(p.browser is None for p in pools)
+
+
+def test_clone_file_falls_back_to_copy(tmp_path, monkeypatch):
+    src = tmp_path / 'src'
+    dst = tmp_path / 'dst'
+    src.write_bytes(os.urandom(4096))
+    calls = []
+    if chatgpt.IS_LINUX:
+        def ioctl(*args):
+            calls.append(args)
+            raise OSError('clone not supported')
+        monkeypatch.setattr(chatgpt.fcntl, 'ioctl', ioctl)
+    assert clone_file(str(src), str(dst)) == str(dst)
+    assert len(calls) == (1 if chatgpt.IS_LINUX else 0)
+    assert filecmp.cmp(src, dst, shallow=False)
+    assert os.stat(src).st_mtime == os.stat(dst).st_mtime